@@ -1,45 +1,147 @@
 import os
 import urllib.parse
-import requests
 import re
 import string
 import time
 import random
 import json
-from yt_dlp import YoutubeDL
-from tkinter import Tk, ttk, filedialog, StringVar, messagebox
-from dotenv import load_dotenv
-import spotipy  
-from spotipy import SpotifyOAuth
-from spotipy.oauth2 import SpotifyOauthError
 import threading
 import logging
-from fake_useragent import UserAgent
 import subprocess
 import sys
 import platform
 import tempfile
 import shutil
+import argparse
+import functools
+import itertools
+import collections
+import contextlib
+import gc
+import secrets
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
-# Setup logging for troubleshooting
-logging.basicConfig(filename="downloader.log", level=logging.INFO, format='%(asctime)s - %(message)s')
+# Heavy third-party modules (yt_dlp, spotipy, requests, tkinter, fake_useragent, dotenv) are
+# imported where they are first used so headless runs and status queries start quickly
+
+# Startup budgets checked by --benchmark-startup
+IMPORT_BUDGET_MS = 75
+STARTUP_BUDGET_MS = 250
+
+# Log file rotation: LOG_BACKUPS old files of up to LOG_MAX_BYTES each are kept
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "downloader.log")
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+
+# Quiet mode drops per-track console output, everything still goes to the log
+quiet = False
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, with the track_id, stage and elapsed fields passed via extra="""
+
+    FIELDS = ('track_id', 'stage', 'elapsed')
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        # Records arrive from the queue with the traceback already rendered to exc_text
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+log_listener = None
+
+def setup_logging(log_file=LOG_FILE):
+    """Route log records through a queue to a background writer with a size-rotated JSON log file"""
+    global log_listener
+    import copy
+    import queue
+    from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+    file_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    file_handler.setFormatter(JsonLogFormatter())
+
+    class StructuredQueueHandler(QueueHandler):
+        def prepare(self, record):
+            # The stock prepare() folds the traceback into msg and drops exc_info; keep the
+            # message plain and carry the rendered traceback in exc_text for the JSON formatter
+            record = copy.copy(record)
+            record.message = record.getMessage()
+            record.msg, record.args = record.message, None
+            if record.exc_info and not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+            return record
+
+    # Callers only enqueue records, the listener thread does the file writes
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(StructuredQueueHandler(log_queue))
+
+    log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+def say(message, level=logging.INFO, **fields):
+    """Log a message with structured fields and echo it to the console unless in quiet mode"""
+    logging.log(level, message, extra=fields)
+    if not quiet:
+        print(message)
+
+# External tools probed once per session; ffmpeg and ffprobe are required, aria2c optional
+DEPENDENCY_PROBES = {
+    'ffmpeg': ['ffmpeg', '-version'],
+    'ffprobe': ['ffprobe', '-version'],
+    'aria2c': ['aria2c', '--version'],
+}
+
+def probe_dependency(name):
+    command = DEPENDENCY_PROBES[name]
+    # Skip spawning a process for tools that aren't on PATH at all
+    if shutil.which(command[0]) is None:
+        return False
+    try:
+        subprocess.run(command, capture_output=True, check=True)
+        return True
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return False
+
+@functools.lru_cache(maxsize=None)
+def probe_dependencies():
+    """Probe all external tools in parallel, cached for the rest of the session"""
+    with ThreadPoolExecutor(max_workers=len(DEPENDENCY_PROBES)) as executor:
+        results = executor.map(probe_dependency, DEPENDENCY_PROBES)
+        return dict(zip(DEPENDENCY_PROBES, results))
 
 # Check for required dependencies
 def check_dependencies():
     missing_deps = []
-    
+    available = probe_dependencies()
+
     # Check for FFmpeg
-    try:
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-    except (subprocess.SubprocessError, FileNotFoundError):
+    if not available['ffmpeg']:
         missing_deps.append("FFmpeg")
-    
+
+    # ffprobe reads codecs for the format policy and durations for verification
+    if not available['ffprobe']:
+        missing_deps.append("ffprobe (part of FFmpeg)")
+
     # Check for aria2c (optional)
-    try:
-        subprocess.run(['aria2c', '--version'], capture_output=True, check=True)
-    except (subprocess.SubprocessError, FileNotFoundError):
-        logging.warning("aria2c not found - some download methods may be slower")
-    
+    if not available['aria2c'] and download_backend == 'aria2':
+        logging.warning("aria2c not found - falling back to yt-dlp downloads, which may be slower")
+
     if missing_deps:
         error_msg = "Missing required dependencies:\n\n"
         for dep in missing_deps:
@@ -48,44 +150,207 @@ def check_dependencies():
         error_msg += "Windows: Download from https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip\n"
         error_msg += "macOS: brew install ffmpeg\n"
         error_msg += "Linux: sudo apt-get install ffmpeg"
-        messagebox.showerror("Missing Dependencies", error_msg)
+        show_error("Missing Dependencies", error_msg)
         return False
     return True
 
-# Load environment variables
-load_dotenv(dotenv_path='.env')
+# Settings from .env and the environment, filled in by load_config()
+client_id = None
+client_secret = None
+redirect_uri = None
+auth_mode = "oauth"
+public_playlists = []
+quality_tier = "high"
+output_format = "m4a"
+download_backend = "ytdlp"
+profile_mode = None
+config_loaded = False
+
+def load_config():
+    """Read .env and the environment on first use instead of at import"""
+    global config_loaded, client_id, client_secret, redirect_uri, auth_mode, public_playlists, quality_tier, output_format
+    global download_backend, profile_mode
+    if config_loaded:
+        return
+    from dotenv import load_dotenv
+
+    # Load environment variables
+    load_dotenv(dotenv_path='.env')
+
+    # Setup Spotify API credentials
+    client_id = os.getenv("SPOTIFY_CLIENT_ID")
+    client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
+    redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI")
+
+    auth_mode = os.getenv("SPOTIFY_AUTH_MODE", "oauth").lower()
+
+    # Public playlists to offer in client-credentials mode, which can't list the user's own playlists
+    public_playlists = [p.strip() for p in os.getenv("SPOTIFY_PLAYLISTS", "").split(",") if p.strip()]
+
+    quality_tier = os.getenv("AUDIO_QUALITY", "high").lower()
+    if quality_tier not in QUALITY_TIERS:
+        logging.warning(f"Unknown AUDIO_QUALITY '{quality_tier}', using 'high'")
+        quality_tier = 'high'
+
+    output_format = os.getenv("AUDIO_FORMAT", "m4a").lower()
+    if output_format not in REMUX_CODECS:
+        logging.warning(f"Unknown AUDIO_FORMAT '{output_format}', using 'm4a'")
+        output_format = 'm4a'
+
+    download_backend = os.getenv("DOWNLOADER_BACKEND", download_backend).lower()
+    if download_backend not in ('ytdlp', 'aria2'):
+        logging.warning(f"Unknown DOWNLOADER_BACKEND '{download_backend}', using 'ytdlp'")
+        download_backend = 'ytdlp'
+
+    profile_mode = os.getenv("DOWNLOADER_PROFILE") or profile_mode
+    if profile_mode not in (None, 'sample', 'cprofile'):
+        logging.warning(f"Unknown DOWNLOADER_PROFILE '{profile_mode}', using 'sample'")
+        profile_mode = 'sample'
+
+    config_loaded = True
+
+SPOTIFY_SCOPE = "user-library-read playlist-read-private playlist-read-collaborative"
+
+# Refresh the access token this many seconds before it expires so long runs never see a 401
+TOKEN_REFRESH_MARGIN = 300
+
+# App-only tokens get their own cache file so they never overwrite the user's OAuth token
+CLIENT_CREDENTIALS_CACHE = ".cache-client-credentials"
+
+# Connections kept open to api.spotify.com, shared by all workers
+SPOTIFY_POOL_SIZE = 10
+
+@functools.lru_cache(maxsize=None)
+def locked_cache_handler_class():
+    """Build the cache handler class on first use, spotipy requires a CacheHandler subclass"""
+    from spotipy.cache_handler import CacheFileHandler
+
+    class LockedCacheFileHandler(CacheFileHandler):
+        """Token cache file guarded by a lock and replaced atomically so concurrent workers can't race on it"""
+
+        _lock = threading.Lock()
 
-# Setup Spotify API credentials
-client_id = os.getenv("SPOTIFY_CLIENT_ID")
-client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
-redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI")
+        def get_cached_token(self):
+            with self._lock:
+                return super().get_cached_token()
 
-# Create an instance of the SpotifyOAuth class
-try:
-    sp_oauth = SpotifyOAuth(
+        def save_token_to_cache(self, token_info):
+            with self._lock:
+                temp_path = f"{self.cache_path}.tmp"
+                try:
+                    with open(temp_path, 'w') as f:
+                        json.dump(token_info, f)
+                    os.replace(temp_path, self.cache_path)
+                except IOError as e:
+                    logging.warning(f"Couldn't write token to cache at {self.cache_path}: {e}")
+
+    return LockedCacheFileHandler
+
+class TokenProvider:
+    """Thread-safe access token source that refreshes the token before it expires.
+
+    Implements get_access_token() so it can be passed to spotipy as the auth_manager.
+    """
+
+    def __init__(self, auth_manager, margin=TOKEN_REFRESH_MARGIN):
+        self.auth_manager = auth_manager
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._token_info = None
+
+    def _is_fresh(self, token_info):
+        return bool(token_info) and token_info.get('expires_at', 0) - time.time() > self.margin
+
+    def get_access_token(self, as_dict=False):
+        with self._lock:
+            if not self._is_fresh(self._token_info):
+                self._token_info = self._fetch_token()
+            token_info = self._token_info
+        return token_info if as_dict else token_info['access_token']
+
+    def _fetch_token(self):
+        from spotipy import SpotifyOAuth
+
+        # Another worker or process may already have refreshed the shared cache
+        token_info = self.auth_manager.cache_handler.get_cached_token()
+        user_auth = isinstance(self.auth_manager, SpotifyOAuth)
+        if user_auth and not has_scope(token_info, SPOTIFY_SCOPE):
+            # An app-only token or one granted fewer scopes can't read the user's playlists
+            token_info = None
+        if self._is_fresh(token_info):
+            return token_info
+
+        if user_auth:
+            if token_info and token_info.get('refresh_token'):
+                logging.info("Refreshing Spotify access token")
+                return self.auth_manager.refresh_access_token(token_info['refresh_token'])
+            auth_url = self.auth_manager.get_authorize_url()
+            print("Please go to this URL and authorize the app:", auth_url)
+            auth_code = input("Enter the authorization code: ")
+            return self.auth_manager.get_access_token(auth_code, check_cache=False)
+
+        logging.info("Requesting Spotify client-credentials token")
+        return self.auth_manager.get_access_token(as_dict=True, check_cache=False)
+
+def has_scope(token_info, scope):
+    """True when a cached token was granted every scope in the space-separated scope string"""
+    if not token_info:
+        return False
+    return set(scope.split()) <= set((token_info.get('scope') or '').split())
+
+def create_auth_manager():
+    from spotipy import SpotifyOAuth, SpotifyClientCredentials
+
+    if auth_mode == "client_credentials":
+        cache_handler = locked_cache_handler_class()(cache_path=CLIENT_CREDENTIALS_CACHE)
+        return SpotifyClientCredentials(client_id=client_id, client_secret=client_secret, cache_handler=cache_handler)
+    return SpotifyOAuth(
         client_id=client_id,
         client_secret=client_secret,
         redirect_uri=redirect_uri,
-        scope="user-library-read playlist-read-private playlist-read-collaborative",
+        scope=SPOTIFY_SCOPE,
+        cache_handler=locked_cache_handler_class()(),
     )
-except SpotifyOauthError as e:
-    print(f"Spotify OAuth setup error: {e}")
-    logging.error(f"Spotify OAuth setup error: {e}")
-    exit(1)
-
-# Get access token
-token_info = sp_oauth.get_cached_token()
-if not token_info:
-    auth_url = sp_oauth.get_authorize_url()
-    print("Please go to this URL and authorize the app:", auth_url)
-    auth_code = input("Enter the authorization code: ")
-    token_info = sp_oauth.get_access_token(auth_code)
-
-access_token = token_info["access_token"]
-playlists = {}
 
-def get_auth_header(token):
-    return {"Authorization": "Bearer " + token}
+def create_spotify_session():
+    """HTTP session with a shared connection pool and retries for the Spotify Web API"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(['GET']), respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=SPOTIFY_POOL_SIZE, pool_maxsize=SPOTIFY_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    return session
+
+class SpotifyAuthError(Exception):
+    """Spotify authorization failed, already reported to the user through show_error"""
+
+spotify_client = None
+spotify_client_lock = threading.Lock()
+
+def get_spotify_client():
+    """Create the shared token provider and Spotify client on first use"""
+    global spotify_client
+    with spotify_client_lock:
+        if spotify_client is None:
+            import spotipy
+            from spotipy.oauth2 import SpotifyOauthError
+
+            load_config()
+            try:
+                token_provider = TokenProvider(create_auth_manager())
+                token_provider.get_access_token()
+                spotify_client = spotipy.Spotify(auth_manager=token_provider, requests_session=create_spotify_session())
+            except SpotifyOauthError as e:
+                # Raise instead of exiting, on the GUI's download thread sys.exit would end it silently
+                show_error("Spotify OAuth setup error", str(e))
+                raise SpotifyAuthError(str(e)) from e
+    return spotify_client
+
+playlists = {}
 
 # Function to update the dropdown menu
 def update_playlist_dropdown():
@@ -98,14 +363,27 @@ def update_playlist_dropdown():
     if playlist_names:
         selected_playlist.set(playlist_names[0])
 
+def parse_playlist_id(value):
+    """Accept a playlist ID, spotify:playlist: URI or open.spotify.com URL"""
+    match = re.search(r"playlist[/:]([A-Za-z0-9]+)", value)
+    return match.group(1) if match else value
+
 # Function to fetch user playlists
-def get_user_playlists(token):
+def get_user_playlists():
     print("Retrieving user playlists...")
-    headers = get_auth_header(token)
-    response = requests.get("https://api.spotify.com/v1/me/playlists", headers=headers)
-    response_json = response.json()
-    for item in response_json["items"]:
-        playlists[item["name"]] = item["id"]
+    spotify_client = get_spotify_client()
+    if auth_mode == "client_credentials":
+        # Client credentials can't access /me, offer the configured public playlists instead
+        for value in public_playlists:
+            playlist_id = parse_playlist_id(value)
+            playlist = spotify_client.playlist(playlist_id, fields="name")
+            playlists[playlist["name"]] = playlist_id
+    else:
+        response = spotify_client.current_user_playlists(limit=50)
+        while response:
+            for item in response["items"]:
+                playlists[item["name"]] = item["id"]
+            response = spotify_client.next(response) if response.get("next") else None
     print("Playlists retrieved successfully.")
     update_playlist_dropdown()
 
@@ -114,61 +392,414 @@ def sanitize_filename(filename):
     valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
     return ''.join(c for c in filename if c in valid_chars)
 
-# Global variable to control the downloading process
-is_downloading = True
+# Set by Stop and checked by every stage of an in-flight download, not just between tracks
+cancel_event = threading.Event()
+
+# Seconds one track may take across all its attempts, and the limits for each stage within it
+TRACK_TIME_BUDGET = 600
+STAGE_TIME_BUDGETS = {
+    'search_youtube': 20,
+    'extract_info': 240,
+    'aria2_fetch': 240,
+    'postprocess': 120,
+    'verify': 30,
+}
+# How often blocking waits wake up to look for Stop or an expired deadline
+CANCEL_POLL_INTERVAL = 0.25
+
+class DownloadInterrupted(Exception):
+    """Raised inside a download when Stop is pressed or its time budget runs out"""
+
+class Deadline:
+    """Point in time a track or stage has to finish by, checked cooperatively"""
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def check(self):
+        if cancel_event.is_set():
+            raise DownloadInterrupted("stopped by user")
+        if self.expired():
+            raise DownloadInterrupted("time budget exceeded")
+
+# Deadline of the track being downloaded, per thread so the verify pool keeps its own limits
+deadline_state = threading.local()
+
+def set_track_deadline(seconds):
+    deadline_state.track = Deadline(seconds) if seconds else None
+    return deadline_state.track
+
+def stage_deadline(stage):
+    """Deadline for a stage, cut short by whatever is left of the current track's budget"""
+    seconds = STAGE_TIME_BUDGETS[stage]
+    track_deadline = getattr(deadline_state, 'track', None)
+    if track_deadline is not None:
+        seconds = min(seconds, track_deadline.remaining())
+    return Deadline(seconds)
+
+def run_with_deadline(cmd, stage):
+    """subprocess.run that kills the process on Stop or when the stage runs out of time"""
+    deadline = stage_deadline(stage)
+    # Own process group, so children such as the FFmpeg started by the yt-dlp CLI die with it
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                               start_new_session=os.name == 'posix')
+    try:
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=CANCEL_POLL_INTERVAL)
+                return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+            except subprocess.TimeoutExpired:
+                if cancel_event.is_set() or deadline.expired():
+                    break
+    except BaseException:
+        # Ctrl+C no longer reaches the separate process group, so don't leave it running
+        kill_process_tree(process)
+        raise
+    kill_process_tree(process)
+    process.communicate()
+    logging.warning(f"Killed {cmd[0]} during {stage}")
+    deadline.check()
+
+def kill_process_tree(process):
+    """Kill a process started by run_with_deadline and everything it started"""
+    if os.name == 'posix':
+        import signal
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+
+@functools.lru_cache(maxsize=None)
+def ytdlp_interrupt_type():
+    """DownloadInterrupted that is also a yt-dlp DownloadCancelled, so ignoreerrors can't swallow it"""
+    from yt_dlp.utils import DownloadCancelled
+    return type('YtdlpDownloadInterrupted', (DownloadInterrupted, DownloadCancelled), {})
+
+def with_deadline(ydl_opts, stage='extract_info'):
+    """yt-dlp options whose hooks abort the download on Stop or when the stage runs out of time"""
+    deadline = stage_deadline(stage)
+
+    def check_deadline(_=None):
+        try:
+            deadline.check()
+        except DownloadInterrupted as e:
+            raise ytdlp_interrupt_type()(str(e)) from None
+
+    def retry_sleep(n):
+        # Called before every yt-dlp retry, so retries can't outlive the budget either
+        check_deadline()
+        return 0
+
+    return {
+        **ydl_opts,
+        'progress_hooks': ydl_opts.get('progress_hooks', []) + [check_deadline],
+        'postprocessor_hooks': ydl_opts.get('postprocessor_hooks', []) + [check_deadline],
+        'retry_sleep_functions': {kind: retry_sleep for kind in ('http', 'fragment', 'file_access', 'extractor')},
+        'socket_timeout': max(1, min(ydl_opts.get('socket_timeout', 30), deadline.remaining())),
+    }
 
 # Function to stop the download process
 def stop_downloading():
-    global is_downloading
-    is_downloading = False
-    status_label.config(text="Downloading stopped.")
+    cancel_event.set()
+    set_status("Downloading stopped.")
+
+# Only the playlist item fields the downloader uses; the API skips markets, previews etc.
+PLAYLIST_TRACK_FIELDS = (
+    "items(track(id,name,duration_ms,track_number,disc_number,external_ids(isrc),artists(name),"
+    "album(id,name,release_date,total_tracks,images(url),artists(name)))),next"
+)
+
+# Track fields whose values repeat across a library and are shared via sys.intern
+INTERNED_FIELDS = ('artist', 'artists', 'album', 'album_id', 'album_artist', 'release_date', 'art_url')
+
+def intern_or_none(value):
+    return sys.intern(value) if value else None
+
+class TrackRecord:
+    """Compact track record holding only the fields the downloader uses.
+
+    Artist, album and art URL strings repeat across a library, so they are interned and shared.
+    """
+
+    __slots__ = ('id', 'name', 'artist', 'artists', 'album', 'album_id', 'album_artist', 'release_date',
+                 'track_number', 'total_tracks', 'disc_number', 'isrc', 'duration_ms', 'art_url')
+
+    def __init__(self, id, name, artist, artists, album, album_id, album_artist, release_date,
+                 track_number, total_tracks, disc_number, isrc, duration_ms, art_url):
+        self.id = id
+        self.name = name
+        self.artist = artist
+        self.artists = artists
+        self.album = album
+        self.album_id = album_id
+        self.album_artist = album_artist
+        self.release_date = release_date
+        self.track_number = track_number
+        self.total_tracks = total_tracks
+        self.disc_number = disc_number
+        self.isrc = isrc
+        self.duration_ms = duration_ms
+        self.art_url = art_url
+
+    @classmethod
+    def from_spotify(cls, track):
+        """Build a record from a Spotify track object, or None for items without a playable track"""
+        if not track or not track.get('name') or not track.get('artists'):
+            return None
+        album = track.get('album') or {}
+        images = album.get('images') or []
+        artist_names = [a['name'] for a in track['artists'] if a.get('name')]
+        return cls(
+            id=track.get('id'),
+            name=track['name'],
+            artist=intern_or_none(artist_names[0] if artist_names else None),
+            artists=intern_or_none(", ".join(artist_names)),
+            album=intern_or_none(album.get('name')),
+            album_id=intern_or_none(album.get('id')),
+            album_artist=intern_or_none(", ".join(a['name'] for a in album.get('artists', []) if a.get('name'))),
+            release_date=intern_or_none(album.get('release_date')),
+            track_number=track.get('track_number'),
+            total_tracks=album.get('total_tracks'),
+            disc_number=track.get('disc_number'),
+            isrc=(track.get('external_ids') or {}).get('isrc'),
+            duration_ms=track.get('duration_ms'),
+            # Spotify lists album images largest first
+            art_url=intern_or_none(images[0]['url'] if images else None),
+        )
+
+def records_from_items(items):
+    """Convert one page of playlist items to track records, dropping local files and removed tracks"""
+    records = []
+    for item in items:
+        record = TrackRecord.from_spotify(item.get('track'))
+        if record is not None:
+            records.append(record)
+    return records
+
+def track_file_name(track):
+    return sanitize_filename(f"{track.artist} - {track.name}")
+
+# Playlist snapshots are JSON Lines: a header object naming the columns, then one track per line as
+# an array in that column order, so plans stay diffable and load with a single JSON parse
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILE = "playlist.snapshot.jsonl"
+SNAPSHOT_FIELDS = TrackRecord.__slots__ + ('youtube_id',)
+
+def track_key(track):
+    """Stable key for a track, local files have no Spotify ID"""
+    return track.id or f"{track.artist} - {track.name}"
+
+def write_snapshot(path, playlist_id, playlist_name, tracks, youtube_ids):
+    """Write a playlist plan with the YouTube ID chosen for each track"""
+    header = {
+        'snapshot': SNAPSHOT_VERSION,
+        'playlist_id': playlist_id,
+        'name': playlist_name,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'fields': SNAPSHOT_FIELDS,
+    }
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for track in tracks:
+            row = [getattr(track, field) for field in TrackRecord.__slots__]
+            row.append(youtube_ids.get(track_key(track)))
+            f.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + "\n")
+    os.replace(temp_path, path)
+
+def read_snapshot(path):
+    """Load a snapshot, returns (header, tracks, youtube_ids); blank lines left by merges are skipped"""
+    with open(path, encoding='utf-8') as f:
+        header_line = f.readline()
+        if not header_line.strip():
+            raise ValueError(f"Empty snapshot: {path}")
+        header = json.loads(header_line)
+        if header.get('snapshot') != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version in {path}: {header.get('snapshot')}")
+        # Split on "\n" only, str.splitlines() would also break on U+2028 inside track names
+        lines = [line for line in f.read().split("\n") if line.strip()]
+
+    # The load allocates hundreds of thousands of objects that all stay alive, collecting midway is wasted work
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return header, *snapshot_records(header, lines)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def snapshot_records(header, lines):
+    """Build track records and the YouTube ID map from a snapshot's row lines"""
+    # JSON strings can't contain raw newlines, so the rows join into one array for a single parse
+    rows = json.loads("[" + ",".join(lines) + "]")
+
+    # Older or newer snapshots may order or name columns differently
+    fields = tuple(header['fields'])
+    if fields != SNAPSHOT_FIELDS:
+        rows = [[row[fields.index(field)] if field in fields else None for field in SNAPSHOT_FIELDS] for row in rows]
+
+    # Work column by column so interning and record building run in map() rather than a per-row loop
+    columns = list(zip(*rows)) if rows else [()] * len(SNAPSHOT_FIELDS)
+    del rows
+    for field in INTERNED_FIELDS:
+        # Share repeated strings like TrackRecord.from_spotify does, interning each distinct value once
+        column = SNAPSHOT_FIELDS.index(field)
+        interned = {value: sys.intern(value) for value in set(columns[column]) if value}
+        columns[column] = map(interned.get, columns[column], columns[column])
+
+    tracks = list(map(TrackRecord, *columns[:-1]))
+    youtube_ids = {track_key(track): youtube_id for track, youtube_id in zip(tracks, columns[-1]) if youtube_id}
+    return tracks, youtube_ids
+
+def load_snapshot_ids(path):
+    """YouTube IDs from an existing snapshot, empty when there is none or it can't be read"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        return read_snapshot(path)[2]
+    except (IOError, ValueError, KeyError, IndexError, TypeError) as e:
+        logging.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return {}
+
+def merge_snapshots(paths, output_path):
+    """Merge snapshots in order: later files win for track data, known YouTube IDs are kept"""
+    merged = {}
+    youtube_ids = {}
+    header = None
+    for path in paths:
+        header, tracks, ids = read_snapshot(path)
+        for track in tracks:
+            merged[track_key(track)] = track
+        youtube_ids.update(ids)
+    write_snapshot(output_path, header['playlist_id'], header['name'], merged.values(), youtube_ids)
+    print(f"Merged {len(paths)} snapshots into {output_path}: {len(merged)} tracks, {len(youtube_ids)} with YouTube IDs")
+    return 0
+
+def diff_snapshots(old_path, new_path):
+    """Print tracks added, removed or resolved to a different YouTube video between two snapshots"""
+    _, old_tracks, old_ids = read_snapshot(old_path)
+    _, new_tracks, new_ids = read_snapshot(new_path)
+    old = {track_key(track): track for track in old_tracks}
+    new = {track_key(track): track for track in new_tracks}
+
+    for key in sorted(new.keys() - old.keys()):
+        print(f"+ {new[key].artist} - {new[key].name}")
+    for key in sorted(old.keys() - new.keys()):
+        print(f"- {old[key].artist} - {old[key].name}")
+    for key in sorted(new.keys() & old.keys()):
+        if old_ids.get(key) != new_ids.get(key):
+            print(f"~ {new[key].artist} - {new[key].name}: {old_ids.get(key)} -> {new_ids.get(key)}")
+    return 0
+
+def export_snapshot(playlist, output_path, resolve=False):
+    """Save a playlist plan from Spotify, optionally resolving YouTube IDs so it can run offline"""
+    playlist_id = parse_playlist_id(playlist)
+    playlist_name = get_spotify_client().playlist(playlist_id, fields="name")["name"]
+    tracks = get_playlist_tracks(playlist_id)
+
+    youtube_ids = {}
+    if resolve:
+        for track_num, track in enumerate(tracks, start=1):
+            video_ids = search_youtube(f"{track.name} {track.artist} audio")
+            if video_ids:
+                youtube_ids[track_key(track)] = video_ids[0]
+            say(f"Resolved {track_num}/{len(tracks)}: {track.name}", track_id=track.id, stage='search_youtube')
+            pause(1, 2)
+
+    write_snapshot(output_path, playlist_id, playlist_name, tracks, youtube_ids)
+    print(f"Snapshot written to {output_path}: {len(tracks)} tracks")
+    return 0
 
 # Fetch tracks from the selected playlist and display the number of tracks retrieved
-def get_playlist_tracks(token, playlist_id):
-    print(f"Retrieving tracks for playlist ID: {playlist_id}")
-    
-    # Setup Spotipy with the provided token
-    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=client_id, client_secret=client_secret, redirect_uri=redirect_uri))
-    
+def get_playlist_tracks(playlist_id):
+    say(f"Retrieving tracks for playlist ID: {playlist_id}")
+
+    spotify_client = get_spotify_client()
     tracks = []
     limit = 100  # Spotify's maximum limit per request
     offset = 0
-    
+
     # Loop to fetch tracks with pagination using offset
     while True:
-        response = sp.playlist_tracks(playlist_id, limit=limit, offset=offset)
-        tracks.extend(response['items'])
-        
+        response = spotify_client.playlist_tracks(playlist_id, fields=PLAYLIST_TRACK_FIELDS, limit=limit, offset=offset)
+        # Keep compact records only, the page JSON is released on the next iteration
+        tracks.extend(records_from_items(response['items']))
+
         # Logging and print status
-        print(f"Fetched {len(response['items'])} tracks, total: {len(tracks)}")
-        
+        say(f"Fetched {len(response['items'])} tracks, total: {len(tracks)}")
+
         # Break the loop if fewer than 'limit' tracks are returned (i.e., we've fetched all tracks)
         if len(response['items']) < limit:
             break
-        
+
         # Increment the offset for the next batch of tracks
         offset += limit
 
     total_tracks = len(tracks)
-    print(f"{total_tracks} tracks retrieved successfully.")
-    
-    # Update the status label to show the number of tracks retrieved
-    screen.after(0, lambda: status_label.config(text=f"{total_tracks} tracks retrieved successfully."))
-    
+    logging.info(f"{total_tracks} tracks retrieved successfully.")
+
+    # Update the status label (or the console when headless) with the number of tracks retrieved
+    set_status(f"{total_tracks} tracks retrieved successfully.")
+
     return tracks
 
+# GUI widgets, only set once build_gui() has run; headless runs report to the console
+screen = None
+status_label = None
+path_label = None
+selected_playlist = None
+playlist_dropdown = None
+
+def set_status(text):
+    """Show a status message in the GUI (from any thread) or on the console when headless"""
+    if screen is not None:
+        screen.after(0, status_label.config, {'text': text})
+    elif not quiet:
+        print(text)
+
+def show_error(title, message):
+    logging.error(f"{title}: {message}")
+    if screen is not None:
+        from tkinter import messagebox
+        messagebox.showerror(title, message)
+    else:
+        print(f"{title}: {message}", file=sys.stderr)
+
 # Function to update the progress in the GUI
 def update_status(current_track, total_tracks):
-    status_label.config(text=f"Downloading song {current_track} of {total_tracks}...")
+    if quiet and screen is None:
+        return
+    set_status(f"Downloading song {current_track} of {total_tracks}...")
+
+def update_progress(current_track, total_tracks, percent, speed):
+    if quiet and screen is None:
+        return
+    set_status(f"Downloading song {current_track} of {total_tracks}... {percent:.0f}% ({speed / 1024:.0f} KB/s)")
+
+# fake_useragent loads its browser database when constructed, so build it once
+user_agent_source = None
 
 def get_random_user_agent():
+    global user_agent_source
     try:
-        ua = UserAgent()
-        return ua.random
+        if user_agent_source is None:
+            from fake_useragent import UserAgent
+            user_agent_source = UserAgent()
+        return user_agent_source.random
     except:
         return "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 
 def search_youtube(query):
+    import requests
+
     headers = {
         'User-Agent': get_random_user_agent(),
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
@@ -181,7 +812,8 @@ def search_youtube(query):
     
     search_url = f"https://www.youtube.com/results?search_query={urllib.parse.quote(query)}"
     try:
-        response = requests.get(search_url, headers=headers, timeout=10)
+        response = requests.get(search_url, headers=headers,
+                                timeout=max(1, min(10, stage_deadline('search_youtube').remaining())))
         video_ids = re.findall(r"watch\?v=(\S{11})", response.text)
         return list(set(video_ids))[:3]  # Return top 3 unique video IDs
     except Exception as e:
@@ -222,6 +854,8 @@ def check_chrome_cookies():
 
 def get_ffmpeg_path():
     """Get the path to FFmpeg executable"""
+    import requests
+
     try:
         # First check if FFmpeg is in the script's directory
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -306,20 +940,513 @@ def get_ffmpeg_path():
         
     return None
 
-def download_with_ytdlp(video_url, output_path, track_name):
+# Stack sampling interval for --profile
+PROFILE_SAMPLE_INTERVAL = 0.01
+
+class StageProfiler:
+    """Wall and CPU time per pipeline stage, plus a stack sampler and optionally cProfile for a run.
+
+    CPU time is the calling thread's plus that of child processes (FFmpeg, ffprobe) finished
+    during the stage.
+    """
+
+    def __init__(self, mode='sample'):
+        self.mode = mode
+        self.stats = {}
+        self.samples = collections.Counter()
+        self._lock = threading.Lock()
+        self._active = {}
+        self._watched = set()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._cprofile = None
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ident = threading.get_ident()
+        outer = self._active.get(ident)
+        self._active[ident] = name
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time() + children_cpu_seconds()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() + children_cpu_seconds() - cpu_start
+            if outer is None:
+                self._active.pop(ident, None)
+            else:
+                self._active[ident] = outer
+            with self._lock:
+                entry = self.stats.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += wall
+                entry[2] += cpu
+
+    def start(self):
+        """Start profiling the calling thread"""
+        self._watched.add(threading.get_ident())
+        if self.mode == 'cprofile':
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        # The sampler also runs under cProfile, pstats has no full stacks for the folded file
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _sample_loop(self):
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            for ident in list(self._watched):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                # Root the stack at the active stage so flamegraphs group by stage
+                stack.append(self._active.get(ident, 'other'))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write_report(self, folder):
+        """Write the stage summary and a flamegraph-compatible folded stack file into folder"""
+        total_wall = time.perf_counter() - self._started
+        report_path = os.path.join(folder, "profile_report.txt")
+        with self._lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+
+        lines = [f"Run wall time: {total_wall:.1f} s", "",
+                 f"{'Stage':<16}{'Calls':>8}{'Wall (s)':>12}{'CPU (s)':>12}{'Wall %':>9}"]
+        for name, (calls, wall, cpu) in stats:
+            lines.append(f"{name:<16}{calls:>8}{wall:>12.2f}{cpu:>12.2f}{wall * 100 / total_wall:>8.1f}%")
+
+        if self._cprofile is not None:
+            import io
+            import pstats
+            self._cprofile.dump_stats(os.path.join(folder, "profile.prof"))
+            output = io.StringIO()
+            pstats.Stats(self._cprofile, stream=output).sort_stats('cumulative').print_stats(30)
+            lines += ["", output.getvalue()]
+
+        with open(report_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        print("\n".join(lines[:len(stats) + 3]))
+
+        if self.samples:
+            with open(os.path.join(folder, "profile_stacks.folded"), 'w') as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        logging.info(f"Profile report written to {report_path}")
+
+# Active profiler for the current run, None when profiling is off
+profiler = None
+
+def profile_stage(name):
+    """Time a pipeline stage when profiling is on, a no-op otherwise"""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+def pause(low, high):
+    """Random delay between requests, recorded as its own stage and cut short by Stop"""
+    with profile_stage('sleep'):
+        cancel_event.wait(random.uniform(low, high))
+
+# Audio quality tiers: minimum acceptable stream bitrate in kbps (None means best available)
+QUALITY_TIERS = {
+    'low': 48,
+    'medium': 96,
+    'high': 128,
+    'best': None,
+}
+
+# Bitrate used for the tier when a transcode cannot be avoided
+TRANSCODE_BITRATES = {
+    'low': 96,
+    'medium': 128,
+    'high': 192,
+    'best': 256,
+}
+
+# Source codecs that can be copied into each output container with a remux only
+REMUX_CODECS = {
+    'm4a': ('aac', 'mp4a'),
+    'opus': ('opus',),
+    'mp3': ('mp3',),
+}
+
+# FFmpeg encoders used for each output container when transcoding
+TRANSCODE_ENCODERS = {
+    'm4a': 'aac',
+    'opus': 'libopus',
+    'mp3': 'libmp3lame',
+}
+
+# Streams are accepted slightly under the tier bitrate, YouTube reports e.g. 129.5k for its 128k AAC
+BITRATE_TOLERANCE = 0.95
+
+# Rough CPU cost of transcoding one second of audio, used until a real transcode has been measured
+DEFAULT_TRANSCODE_CPU_RATIO = 0.02
+
+# Running totals for the format policy report
+format_stats_lock = threading.Lock()
+format_stats = {}
+
+def reset_format_stats():
+    with format_stats_lock:
+        format_stats.clear()
+        format_stats.update({
+            'remuxed': 0,
+            'transcoded': 0,
+            'bytes_saved': 0,
+            'remuxed_seconds': 0.0,
+            'transcoded_seconds': 0.0,
+            'transcode_cpu_seconds': 0.0,
+        })
+
+reset_format_stats()
+
+def children_cpu_seconds():
+    """CPU time used by finished child processes (FFmpeg), 0 where the platform can't report it"""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def describe_ytdlp_format(fmt):
+    """Normalize a yt-dlp format dict into the fields used by the format policy"""
+    return {
+        'itag': str(fmt.get('format_id')),
+        'codec': (fmt.get('acodec') or '').split('.')[0].lower(),
+        'ext': fmt.get('ext'),
+        'bitrate': fmt.get('abr') or fmt.get('tbr') or 0,
+        'size': fmt.get('filesize') or fmt.get('filesize_approx') or 0,
+        'source': fmt,
+    }
+
+def describe_invidious_format(fmt):
+    """Normalize an Invidious adaptiveFormats entry into the fields used by the format policy"""
+    mime = fmt.get('type', '')
+    match = re.search(r'codecs="([^"]+)"', mime)
+    return {
+        'itag': str(fmt.get('itag')),
+        'codec': match.group(1).split('.')[0].lower() if match else '',
+        'ext': 'm4a' if mime.startswith('audio/mp4') else 'webm',
+        'bitrate': int(fmt.get('bitrate') or 0) / 1000,
+        'size': int(fmt.get('clen') or 0),
+        'source': fmt,
+    }
+
+def estimated_size(fmt, duration):
+    """Stream size in bytes, estimated from the bitrate when the extractor doesn't report it"""
+    if fmt['size']:
+        return fmt['size']
+    if duration:
+        return int(fmt['bitrate'] * 1000 / 8 * duration)
+    return 0
+
+def select_audio_format(formats, tier=None, container=None):
+    """Pick the cheapest audio stream that meets the quality tier, preferring remux-only codecs"""
+    if not formats:
+        return None
+    tier = tier or quality_tier
+    remux_codecs = REMUX_CODECS[container or output_format]
+    min_bitrate = QUALITY_TIERS[tier]
+
+    if min_bitrate is not None:
+        eligible = [f for f in formats if f['bitrate'] >= min_bitrate * BITRATE_TOLERANCE]
+        if eligible:
+            return min(eligible, key=lambda f: (f['codec'] not in remux_codecs, f['bitrate'], f['size']))
+
+    # 'best' tier, or nothing meets the tier: take the highest bitrate, but a remux-only stream within
+    # the tolerance of it wins, re-encoding e.g. 135k opus to AAC would cost CPU and quality for nothing
+    best = max(formats, key=lambda f: (f['bitrate'], f['codec'] in remux_codecs))
+    remuxable = [f for f in formats
+                 if f['codec'] in remux_codecs and f['bitrate'] >= best['bitrate'] * BITRATE_TOLERANCE]
+    return max(remuxable, key=lambda f: f['bitrate']) if remuxable else best
+
+def needs_transcode(codec, container=None):
+    return codec not in REMUX_CODECS[container or output_format]
+
+def record_format_choice(chosen, formats, duration):
+    """Add the savings of one format decision to the running totals"""
+    largest = max(estimated_size(f, duration) for f in formats)
+    bytes_saved = max(0, largest - estimated_size(chosen, duration))
+    with format_stats_lock:
+        format_stats['bytes_saved'] += bytes_saved
+        if needs_transcode(chosen['codec']):
+            format_stats['transcoded'] += 1
+        else:
+            format_stats['remuxed'] += 1
+            format_stats['remuxed_seconds'] += duration or 0
+
+def record_transcode_cost(cpu_seconds, duration):
+    with format_stats_lock:
+        format_stats['transcode_cpu_seconds'] += cpu_seconds
+        format_stats['transcoded_seconds'] += duration or 0
+
+def estimate_cpu_seconds_saved():
+    """CPU seconds avoided by remuxing, using the measured transcode cost when there is one"""
+    with format_stats_lock:
+        ratio = DEFAULT_TRANSCODE_CPU_RATIO
+        if format_stats['transcode_cpu_seconds'] > 0 and format_stats['transcoded_seconds'] > 0:
+            ratio = format_stats['transcode_cpu_seconds'] / format_stats['transcoded_seconds']
+        return format_stats['remuxed_seconds'] * ratio
+
+def log_format_savings():
+    with format_stats_lock:
+        remuxed = format_stats['remuxed']
+        transcoded = format_stats['transcoded']
+        mb_saved = format_stats['bytes_saved'] / (1024 * 1024)
+    message = (f"Format policy ({quality_tier}, {output_format}): {remuxed} remuxed, {transcoded} transcoded, "
+               f"~{mb_saved:.1f} MB and ~{estimate_cpu_seconds_saved():.1f} CPU-seconds saved")
+    say(message)
+
+def policy_format_string(tier=None, container=None):
+    """yt-dlp format expression equivalent to the format policy, for the CLI fallback"""
+    min_bitrate = QUALITY_TIERS[tier or quality_tier]
+    if min_bitrate is None:
+        return "bestaudio/best"
+    floor = int(min_bitrate * BITRATE_TOLERANCE)
+    remux_filters = "".join(f"worstaudio[abr>={floor}][acodec^={codec}]/" for codec in REMUX_CODECS[container or output_format])
+    return f"{remux_filters}worstaudio[abr>={floor}]/bestaudio/best"
+
+def audio_postprocessors():
+    """FFmpegExtractAudio copies the stream when the codec already fits the container"""
+    return [{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': output_format,
+        'preferredquality': str(TRANSCODE_BITRATES[quality_tier]),
+    }]
+
+class FormatPolicySelector:
+    """yt-dlp format selector that applies the format policy to the formats extracted once per video"""
+
+    def __init__(self, protocols=None):
+        # Restrict the choice to these yt-dlp protocols, e.g. plain HTTP(S) for downloaders that
+        # can't follow HLS or DASH manifests
+        self.protocols = protocols
+        self.formats = []
+        self.chosen = None
+        self._cpu_start = None
+        self._transcode_cpu = 0.0
+
+    def __call__(self, ctx):
+        formats = ctx.get('formats', [])
+        self.formats = [describe_ytdlp_format(f) for f in formats
+                        if f.get('acodec') not in (None, 'none') and f.get('vcodec') in (None, 'none')
+                        and (self.protocols is None or f.get('protocol') in self.protocols)]
+        self.chosen = select_audio_format(self.formats)
+        if self.chosen is not None:
+            logging.info(f"Selected itag {self.chosen['itag']} ({self.chosen['codec']}, {self.chosen['bitrate']:.0f}k)")
+            yield self.chosen['source']
+        elif formats:
+            # No audio-only streams, fall back to the best combined format
+            yield formats[-1]
+
+    def postprocessor_hook(self, d):
+        if d.get('postprocessor') != 'ExtractAudio':
+            return
+        if d['status'] == 'started':
+            self._cpu_start = children_cpu_seconds()
+        elif d['status'] == 'finished' and self._cpu_start is not None:
+            self._transcode_cpu = children_cpu_seconds() - self._cpu_start
+
+    def record(self, info):
+        if self.chosen is None or info is None:
+            return
+        duration = info.get('duration')
+        record_format_choice(self.chosen, self.formats, duration)
+        # Without the ExtractAudio postprocessor the transcode is measured by convert_audio instead
+        if needs_transcode(self.chosen['codec']) and self._cpu_start is not None:
+            record_transcode_cost(self._transcode_cpu, duration)
+
+def ytdlp_policy_options(selector):
+    return {
+        'format': selector,
+        'postprocessors': audio_postprocessors(),
+        'postprocessor_hooks': [selector.postprocessor_hook],
+    }
+
+def probe_audio(path):
+    """Read the audio codec and duration from the container headers with ffprobe"""
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'a:0',
+        '-show_entries', 'stream=codec_name:format=duration',
+        '-of', 'json',
+        path,
+    ]
+    result = run_with_deadline(cmd, 'verify')
+    if result.returncode != 0:
+        logging.error(f"ffprobe error for {path}: {result.stderr}")
+        return None
+    data = json.loads(result.stdout or '{}')
+    streams = data.get('streams') or [{}]
+    duration = data.get('format', {}).get('duration')
+    return {
+        'codec': streams[0].get('codec_name'),
+        'duration': float(duration) if duration else None,
+    }
+
+# Containers FFmpeg can embed cover art into as an attached picture
+COVER_ART_CONTAINERS = ('m4a', 'mp3')
+
+def build_track_tags(track):
+    """Collect the tags written to the output file from a track record"""
+    return {
+        'title': track.name,
+        'artist': track.artists,
+        'album': track.album,
+        'album_artist': track.album_artist,
+        'date': track.release_date,
+        'track': f"{track.track_number}/{track.total_tracks}" if track.track_number and track.total_tracks else track.track_number,
+        'disc': track.disc_number,
+        'isrc': track.isrc,
+        'album_id': track.album_id,
+        'art_url': track.art_url,
+    }
+
+# Album art is downloaded once per album and shared by every track on it
+ART_CACHE_DIR = os.path.join(tempfile.gettempdir(), "spotify_down_art")
+album_art_lock = threading.Lock()
+album_art_locks = {}
+
+def get_album_art(tags):
+    """Return the path of the cached cover for the track's album, downloading it on first use"""
+    import requests
+
+    if not tags or not tags.get('art_url'):
+        return None
+    album_key = sanitize_filename(tags.get('album_id') or tags['art_url'].rsplit('/', 1)[-1])
+    art_path = os.path.join(ART_CACHE_DIR, f"{album_key}.jpg")
+
+    with album_art_lock:
+        lock = album_art_locks.setdefault(album_key, threading.Lock())
+
+    # Concurrent tracks from the same album wait for a single download
+    with lock:
+        if os.path.exists(art_path) and os.path.getsize(art_path) > 0:
+            return art_path
+        try:
+            os.makedirs(ART_CACHE_DIR, exist_ok=True)
+            response = requests.get(tags['art_url'], timeout=10)
+            response.raise_for_status()
+            temp_path = f"{art_path}.part"
+            with open(temp_path, 'wb') as f:
+                f.write(response.content)
+            os.replace(temp_path, art_path)
+            return art_path
+        except Exception as e:
+            logging.warning(f"Failed to download album art for {tags.get('album')}: {e}")
+            return None
+
+def metadata_args(tags):
+    """FFmpeg -metadata arguments for the tags that are set"""
+    args = []
+    for key in ('title', 'artist', 'album', 'album_artist', 'date', 'track', 'disc', 'isrc'):
+        value = tags.get(key)
+        if value:
+            # The id3v2 muxer has no mapping for isrc and would write a TXXX frame, TSRC is the real one
+            if key == 'isrc' and output_format == 'mp3':
+                key = 'TSRC'
+            args += ['-metadata', f"{key}={value}"]
+    return args
+
+def write_mp4_isrc(path, isrc):
+    """FFmpeg's mp4 muxer has no iTunes atom for ISRC, so add the freeform one iTunes and Picard read"""
+    try:
+        from mutagen.mp4 import MP4, MP4FreeForm
+    except ImportError:
+        logging.warning(f"mutagen is not installed, ISRC not written to {path}")
+        return
+    audio = MP4(path)
+    audio['----:com.apple.iTunes:ISRC'] = [MP4FreeForm(isrc.encode('utf-8'))]
+    audio.save()
+
+def convert_audio(input_path, output_path, tags=None, cover_path=None):
+    """Remux or transcode a downloaded stream into the configured output format, writing tags and
+    cover art in the same FFmpeg pass so the final file is only written once"""
+    try:
+        probe = probe_audio(input_path) or {}
+        codec = probe.get('codec')
+        duration = probe.get('duration')
+
+        if cover_path and output_format not in COVER_ART_CONTAINERS:
+            logging.info(f"Skipping cover art, not supported for .{output_format}")
+            cover_path = None
+
+        cmd = ['ffmpeg', '-y', '-v', 'error', '-i', input_path]
+        if cover_path:
+            cmd += ['-i', cover_path, '-map', '0:a:0', '-map', '1:0', '-c:v', 'copy', '-disposition:v:0', 'attached_pic']
+        else:
+            cmd += ['-vn']
+
+        transcode = needs_transcode(codec)
+        if transcode:
+            cmd += ['-c:a', TRANSCODE_ENCODERS[output_format], '-b:a', f"{TRANSCODE_BITRATES[quality_tier]}k"]
+        else:
+            cmd += ['-c:a', 'copy']
+
+        if tags:
+            cmd += metadata_args(tags)
+        if output_format == 'mp3':
+            cmd += ['-id3v2_version', '3']
+        cmd.append(output_path)
+
+        cpu_start = children_cpu_seconds()
+        with profile_stage('postprocess'):
+            result = run_with_deadline(cmd, 'postprocess')
+        if result.returncode != 0:
+            logging.error(f"FFmpeg conversion error: {result.stderr}")
+            return False
+
+        if transcode:
+            record_transcode_cost(children_cpu_seconds() - cpu_start, duration)
+        if tags and tags.get('isrc') and output_format == 'm4a':
+            write_mp4_isrc(output_path, tags['isrc'])
+
+        return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+    except DownloadInterrupted:
+        # A killed FFmpeg leaves a truncated file behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    except Exception as e:
+        logging.error(f"Error converting {input_path}: {e}")
+        return False
+
+def download_with_ytdlp(video_url, output_path, track_name, tags=None):
     """Download a video using yt-dlp with advanced options to avoid bot detection"""
+    from yt_dlp import YoutubeDL
+
     try:
-        # Create a temporary file for the output
+        # Create a temporary file for the source stream, the tagging pass writes the final file
         temp_dir = os.path.dirname(output_path)
-        temp_output = os.path.join(temp_dir, f"{track_name}.%(ext)s")
+        temp_output = os.path.join(temp_dir, f"{track_name}.source.%(ext)s")
         
+        selector = FormatPolicySelector()
+
         # Advanced options to avoid bot detection
         ydl_opts = {
-            'format': 'bestaudio[ext=m4a]/bestaudio',  # Prefer M4A format
+            'format': selector,
             'outtmpl': temp_output,
             'noplaylist': True,
-            'quiet': False,
-            'no_warnings': False,
+            'quiet': quiet,
+            'no_warnings': quiet,
             'extract_flat': False,
             'http_headers': {
                 'User-Agent': get_random_user_agent(),
@@ -351,20 +1478,27 @@ def download_with_ytdlp(video_url, output_path, track_name):
             except Exception as e:
                 logging.warning(f"Failed to use Chrome cookies: {e}")
         
-        with YoutubeDL(ydl_opts) as ydl:
+        with YoutubeDL(with_deadline(ydl_opts)) as ydl:
             try:
                 # Download the video
-                info = ydl.extract_info(video_url, download=True)
+                with profile_stage('extract_info'):
+                    info = ydl.extract_info(video_url, download=True)
                 if info is None:
                     logging.error("Failed to extract video info")
                     return False
-                
-                # Find the downloaded file
+                selector.record(info)
+
+                # Take the file yt-dlp reports for this download, a stale source left by an earlier
+                # attempt in another container would also match the name scan
                 downloaded_file = None
-                for file in os.listdir(temp_dir):
-                    if file.startswith(track_name):
-                        downloaded_file = os.path.join(temp_dir, file)
-                        break
+                requested = info.get('requested_downloads') or []
+                if requested and requested[0].get('filepath'):
+                    downloaded_file = requested[0]['filepath']
+                else:
+                    for file in os.listdir(temp_dir):
+                        if file.startswith(f"{track_name}.source.") and not file.endswith('.part'):
+                            downloaded_file = os.path.join(temp_dir, file)
+                            break
                 
                 if downloaded_file is None:
                     logging.error("Could not find downloaded file")
@@ -375,34 +1509,402 @@ def download_with_ytdlp(video_url, output_path, track_name):
                     logging.error(f"Downloaded file is invalid or empty: {downloaded_file}")
                     return False
                 
-                # Add .m4a extension if it's missing
-                if not output_path.endswith('.m4a'):
-                    output_path = f"{output_path}.m4a"
+                # Add the output format extension if it's missing
+                if not output_path.endswith(f".{output_format}"):
+                    output_path = f"{output_path}.{output_format}"
                 
-                # Move the file to the final location
+                # Remux or transcode, tag and embed cover art in a single write to the final location
                 try:
-                    shutil.move(downloaded_file, output_path)
-                    # Verify the final file
-                    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+                    try:
+                        converted = convert_audio(downloaded_file, output_path, tags, get_album_art(tags))
+                    finally:
+                        # Also on Stop or timeout, so no source file outlives the attempt
+                        with contextlib.suppress(OSError):
+                            os.remove(downloaded_file)
+                    if converted:
                         return True
                     else:
                         logging.error(f"Final file is invalid or empty: {output_path}")
                         return False
+                except DownloadInterrupted:
+                    raise
                 except Exception as e:
-                    logging.error(f"Error moving file to final location: {e}")
+                    logging.error(f"Error writing file to final location: {e}")
                     return False
                     
+            except DownloadInterrupted:
+                raise
             except Exception as e:
                 logging.error(f"Error during download: {e}")
                 return False
                 
         return False
+    except DownloadInterrupted:
+        raise
     except Exception as e:
         logging.error(f"Error in yt-dlp download: {e}")
         return False
 
-def download_with_invidious(video_id, output_path):
+# A file whose duration is further than this from Spotify's is truncated or the wrong video
+DURATION_TOLERANCE_SECONDS = 5
+DURATION_TOLERANCE_RATIO = 0.05
+
+# Verification runs in a bounded pool so bulk checks can't flood the machine with ffprobe processes
+VERIFY_WORKERS = 4
+VERIFY_CACHE_FILE = ".verify_cache.json"
+AUDIO_EXTENSIONS = ('.m4a', '.mp3', '.opus')
+
+def sniff_audio_header(path):
+    """Identify the container from its first bytes, catches HTML error pages and other junk"""
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    if head[4:8] == b'ftyp':
+        return 'mp4'
+    if head[:3] == b'ID3' or (len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return 'mp3'
+    if head[:4] == b'OggS':
+        return 'ogg'
+    if head[:4] == b'\x1aE\xdf\xa3':
+        return 'webm'
+    return None
+
+def verify_audio_file(path, expected_ms=None):
+    """Check the container header and duration without decoding, returns (ok, reason)"""
+    if os.path.getsize(path) == 0:
+        return False, "empty file"
+    if sniff_audio_header(path) is None:
+        return False, "not an audio container"
+
+    probe = probe_audio(path)
+    if probe is None or not probe.get('duration'):
+        return False, "no duration in container"
+
+    if expected_ms:
+        expected = expected_ms / 1000
+        tolerance = max(DURATION_TOLERANCE_SECONDS, expected * DURATION_TOLERANCE_RATIO)
+        if abs(probe['duration'] - expected) > tolerance:
+            return False, f"duration {probe['duration']:.0f}s, expected {expected:.0f}s"
+    return True, "ok"
+
+class VerifyCache:
+    """Verification results for a library folder, valid while a file's size and mtime are unchanged"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, VERIFY_CACHE_FILE)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def _key(self, path):
+        return os.path.relpath(path, self.folder)
+
+    def get(self, path, stat, expected_ms):
+        with self._lock:
+            entry = self.entries.get(self._key(path))
+        if entry and entry[:3] == [stat.st_size, stat.st_mtime_ns, expected_ms]:
+            return entry[3], entry[4]
+        return None
+
+    def put(self, path, stat, expected_ms, ok, reason):
+        with self._lock:
+            self.entries[self._key(path)] = [stat.st_size, stat.st_mtime_ns, expected_ms, ok, reason]
+
+    def save(self):
+        with self._lock:
+            temp_path = f"{self.path}.tmp"
+            try:
+                with open(temp_path, 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(temp_path, self.path)
+            except IOError as e:
+                logging.warning(f"Couldn't save verification cache {self.path}: {e}")
+
+def verify_track_file(path, expected_ms=None, cache=None):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False, "missing"
+
+    if cache is not None:
+        cached = cache.get(path, stat, expected_ms)
+        if cached is not None:
+            return cached
+
+    try:
+        ok, reason = verify_audio_file(path, expected_ms)
+    except DownloadInterrupted as e:
+        # Not a verdict on the file, so report None and don't cache it
+        return None, str(e)
+    except Exception as e:
+        # Tool or OS failures such as a missing ffprobe say nothing about the file either
+        logging.warning(f"Couldn't verify {path}: {e}")
+        return None, f"verification error: {e}"
+
+    if cache is not None:
+        cache.put(path, stat, expected_ms, ok, reason)
+    return ok, reason
+
+verify_executor = None
+verify_executor_lock = threading.Lock()
+
+def get_verify_executor():
+    global verify_executor
+    with verify_executor_lock:
+        if verify_executor is None:
+            verify_executor = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="verify")
+        return verify_executor
+
+def verify_files(jobs, cache=None):
+    """Verify (path, expected_ms) pairs in the bounded pool, results in the same order"""
+    executor = get_verify_executor()
+    return list(executor.map(lambda job: verify_track_file(job[0], job[1], cache), jobs))
+
+def verify_library(folder):
+    """Re-check every audio file under folder in parallel and report the bad ones"""
+    paths = []
+    for dirpath, _, filenames in os.walk(folder):
+        paths.extend(os.path.join(dirpath, name) for name in filenames if name.lower().endswith(AUDIO_EXTENSIONS))
+    if paths and not probe_dependencies()['ffprobe']:
+        print("ffprobe is required to verify files. Please install FFmpeg.")
+        return 1
+    print(f"Verifying {len(paths)} files in {folder}...")
+
+    cache = VerifyCache(folder)
+    results = verify_files([(path, None) for path in paths], cache)
+    cache.save()
+
+    bad = [(path, reason) for path, (ok, reason) in zip(paths, results) if ok is False]
+    unchecked = [(path, reason) for path, (ok, reason) in zip(paths, results) if ok is None]
+    for path, reason in bad:
+        print(f"BAD: {path} ({reason})")
+        logging.warning(f"Verification failed for {path}: {reason}")
+    for path, reason in unchecked:
+        print(f"UNCHECKED: {path} ({reason})")
+    good = len(paths) - len(bad) - len(unchecked)
+    print(f"{good} of {len(paths)} files verified, {len(bad)} bad, {len(unchecked)} unchecked.")
+    return 1 if bad or unchecked else 0
+
+# aria2c RPC daemon used by the optional segmented downloader backend
+ARIA2_CONNECTIONS = 8  # Connections per file
+ARIA2_MAX_CONCURRENT = 5  # Width of the global download queue shared by all workers
+ARIA2_POLL_INTERVAL = 0.5
+ARIA2_PROTOCOLS = ('http', 'https')
+
+class Aria2Daemon:
+    """Long-running aria2c process controlled over JSON-RPC, shared by every download"""
+
+    def __init__(self):
+        self.port = None
+        self.secret = secrets.token_hex(16)
+        self.process = None
+        self.session = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+    def start(self):
+        import requests
+
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+            # A fresh ephemeral port, 6800 is often taken by the user's own aria2 daemon
+            self.port = free_local_port()
+            cmd = [
+                'aria2c',
+                '--enable-rpc',
+                '--rpc-listen-all=false',
+                f'--rpc-listen-port={self.port}',
+                f'--rpc-secret={self.secret}',
+                f'--max-concurrent-downloads={ARIA2_MAX_CONCURRENT}',
+                f'--max-connection-per-server={ARIA2_CONNECTIONS}',
+                f'--split={ARIA2_CONNECTIONS}',
+                '--min-split-size=1M',
+                '--file-allocation=none',
+                '--allow-overwrite=true',
+                '--auto-file-renaming=false',
+                '--quiet=true',
+            ]
+            self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.session = requests.Session()
+            atexit.register(self.stop)
+
+            # Wait for the RPC endpoint to come up
+            for _ in range(50):
+                if self.process.poll() is not None:
+                    break
+                try:
+                    version = self.call('aria2.getVersion')
+                    logging.info(f"Started aria2c {version.get('version')} RPC daemon on port {self.port}")
+                    return
+                except Exception:
+                    time.sleep(0.1)
+            self.stop()
+            raise RuntimeError("aria2c RPC daemon did not start")
+
+    def call(self, method, *params):
+        payload = {
+            'jsonrpc': '2.0',
+            'id': str(next(self._ids)),
+            'method': method,
+            'params': [f"token:{self.secret}", *params],
+        }
+        response = self.session.post(f"http://127.0.0.1:{self.port}/jsonrpc", json=payload, timeout=10)
+        data = response.json()
+        if 'error' in data:
+            raise RuntimeError(f"aria2 {method} error: {data['error'].get('message')}")
+        return data['result']
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            self.call('aria2.shutdown')
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+def free_local_port():
+    """Ask the OS for an unused loopback port"""
+    import socket
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+aria2_daemon = None
+aria2_daemon_lock = threading.Lock()
+# Set when the daemon fails to start, downloads then go through yt-dlp for the rest of the session
+aria2_failed = False
+
+def get_aria2_daemon():
+    """Start the shared aria2c daemon on first use"""
+    global aria2_daemon, aria2_failed
+    with aria2_daemon_lock:
+        if aria2_daemon is None:
+            aria2_daemon = Aria2Daemon()
+        try:
+            aria2_daemon.start()
+        except Exception:
+            aria2_failed = True
+            raise
+        return aria2_daemon
+
+def use_aria2():
+    return download_backend == 'aria2' and not aria2_failed and probe_dependencies()['aria2c']
+
+def wait_for_aria2(gid, progress=None):
+    """Poll an aria2 download until it finishes, feeding progress to the callback"""
+    daemon = get_aria2_daemon()
+    deadline = stage_deadline('aria2_fetch')
+    try:
+        while True:
+            status = daemon.call('aria2.tellStatus', gid,
+                                 ['status', 'totalLength', 'completedLength', 'downloadSpeed', 'errorMessage'])
+            total = int(status['totalLength'])
+            if progress and total:
+                progress(int(status['completedLength']) * 100 / total, int(status['downloadSpeed']))
+
+            if status['status'] == 'complete':
+                return True
+            if status['status'] in ('error', 'removed'):
+                logging.error(f"aria2 download failed: {status.get('errorMessage')}")
+                return False
+            if cancel_event.is_set() or deadline.expired():
+                logging.warning(f"Abandoning aria2 download {gid}")
+                daemon.call('aria2.remove', gid)
+                # Removal is asynchronous, let aria2 close the file before the caller deletes it
+                for _ in range(20):
+                    if daemon.call('aria2.tellStatus', gid, ['status'])['status'] == 'removed':
+                        break
+                    time.sleep(0.1)
+                deadline.check()
+            cancel_event.wait(ARIA2_POLL_INTERVAL)
+    finally:
+        # Drop the finished entry so the daemon's memory stays flat on big backlogs
+        try:
+            daemon.call('aria2.removeDownloadResult', gid)
+        except Exception:
+            pass
+
+def download_with_aria2(video_url, output_path, track_name, tags=None, progress=None):
+    """Resolve the stream URL with yt-dlp, then fetch it through aria2c with several connections"""
+    from yt_dlp import YoutubeDL
+
+    try:
+        daemon = get_aria2_daemon()
+    except Exception as e:
+        logging.warning(f"aria2 backend unavailable ({e}), using yt-dlp for the rest of the session")
+        return download_with_ytdlp(video_url, output_path, track_name, tags)
+
+    try:
+        # aria2 fetches a single URL, HLS (m3u8) and DASH streams point at a manifest instead of the audio
+        selector = FormatPolicySelector(protocols=ARIA2_PROTOCOLS)
+        ydl_opts = {
+            'format': selector,
+            'noplaylist': True,
+            'quiet': True,
+            'no_warnings': True,
+            'http_headers': {
+                'User-Agent': get_random_user_agent(),
+            },
+            'socket_timeout': 30,
+            'extractor_retries': 10,
+            'geo_bypass': True,
+        }
+
+        # Only add cookies if Chrome is available
+        if check_chrome_cookies():
+            ydl_opts['cookiesfrombrowser'] = ('chrome',)
+
+        with YoutubeDL(with_deadline(ydl_opts)) as ydl:
+            with profile_stage('extract_info'):
+                info = ydl.extract_info(video_url, download=False)
+        if info is None:
+            logging.error("Failed to resolve audio stream")
+            return False
+        if selector.chosen is None:
+            logging.info("No direct HTTP audio stream for aria2, downloading with yt-dlp")
+            return download_with_ytdlp(video_url, output_path, track_name, tags)
+        selector.record(info)
+
+        fmt = selector.chosen['source']
+        temp_dir = os.path.dirname(output_path)
+        source_name = f"{track_name}.source.{fmt.get('ext')}"
+        source_file = os.path.join(temp_dir, source_name)
+        headers = [f"{key}: {value}" for key, value in (fmt.get('http_headers') or {}).items()]
+
+        try:
+            gid = daemon.call('aria2.addUri', [fmt['url']], {
+                'dir': temp_dir,
+                'out': source_name,
+                'header': headers,
+            })
+            with profile_stage('aria2_fetch'):
+                fetched = wait_for_aria2(gid, progress)
+            if not fetched:
+                return False
+
+            # Remux or transcode, tag and embed cover art in a single write to the final location
+            return convert_audio(source_file, output_path, tags, get_album_art(tags))
+        finally:
+            # The source stream and aria2's control file never belong in the library, finished or not
+            for leftover in (source_file, f"{source_file}.aria2"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+    except DownloadInterrupted:
+        raise
+    except Exception as e:
+        logging.error(f"Error in aria2 download: {e}")
+        return False
+
+def download_with_invidious(video_id, output_path, tags=None):
     """Try to download using Invidious API as a fallback"""
+    import requests
+
     try:
         # List of Invidious instances
         instances = [
@@ -424,8 +1926,10 @@ def download_with_invidious(video_id, output_path):
         ]
         
         # Try each instance until one works
+        deadline = stage_deadline('extract_info')
         for instance in instances:
             try:
+                deadline.check()
                 # Get video info from Invidious
                 api_url = f"{instance}/api/v1/videos/{video_id}"
                 response = requests.get(api_url, timeout=10)
@@ -433,30 +1937,38 @@ def download_with_invidious(video_id, output_path):
                 if response.status_code == 200:
                     data = response.json()
                     
-                    # Find the best audio format
-                    audio_formats = [f for f in data.get('adaptiveFormats', []) 
-                                    if f.get('type', '').startswith('audio/')]
-                    
-                    if audio_formats:
-                        # Sort by bitrate and get the best one
-                        best_audio = max(audio_formats, key=lambda x: x.get('bitrate', 0))
-                        audio_url = best_audio.get('url')
-                        
+                    # Pick the audio format according to the format policy
+                    audio_formats = [describe_invidious_format(f) for f in data.get('adaptiveFormats', [])
+                                     if f.get('type', '').startswith('audio/')]
+                    chosen = select_audio_format(audio_formats)
+
+                    if chosen:
+                        audio_url = chosen['source'].get('url')
+
                         if audio_url:
                             # Download the audio
                             audio_response = requests.get(audio_url, stream=True, timeout=30)
-                            
+
                             if audio_response.status_code == 200:
-                                with open(output_path, 'wb') as f:
+                                temp_file = f"{output_path}.{chosen['ext']}.part"
+                                with open(temp_file, 'wb') as f:
                                     for chunk in audio_response.iter_content(chunk_size=8192):
+                                        deadline.check()
                                         if chunk:
                                             f.write(chunk)
-                                return True
+                                record_format_choice(chosen, audio_formats, data.get('lengthSeconds'))
+                                converted = convert_audio(temp_file, output_path, tags, get_album_art(tags))
+                                os.remove(temp_file)
+                                return converted
+            except DownloadInterrupted:
+                raise
             except Exception as e:
                 logging.error(f"Error with Invidious instance {instance}: {e}")
                 continue
                 
         return False
+    except DownloadInterrupted:
+        raise
     except Exception as e:
         logging.error(f"Error in Invidious download: {e}")
         return False
@@ -470,11 +1982,11 @@ def download_with_yt_dlp_cli(video_url, output_path):
         # Build the command
         cmd = [
             "yt-dlp",
-            "--format", "bestaudio/best",
+            "--format", policy_format_string(),
             "--output", temp_output,
             "--extract-audio",
-            "--audio-format", "mp3",
-            "--audio-quality", "192K",
+            "--audio-format", output_format,
+            "--audio-quality", f"{TRANSCODE_BITRATES[quality_tier]}K",
             "--no-playlist",
             "--quiet",
             "--no-warnings",
@@ -487,38 +1999,39 @@ def download_with_yt_dlp_cli(video_url, output_path):
         if check_chrome_cookies():
             cmd.extend(["--cookies-from-browser", "chrome"])
         
-        # Run the command
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # Run the command, killed on Stop or when the download runs out of time
+        result = run_with_deadline(cmd, 'extract_info')
         
         if result.returncode == 0:
             # Find the downloaded file and rename it to the final output path
             temp_dir = os.path.dirname(temp_output)
             for file in os.listdir(temp_dir):
-                if file.startswith("temp_cli_") and file.endswith(".mp3"):
-                    os.rename(os.path.join(temp_dir, file), output_path)
+                if file.startswith("temp_cli_") and file.endswith(f".{output_format}"):
+                    with profile_stage('file_move'):
+                        os.rename(os.path.join(temp_dir, file), output_path)
                     return True
                     
         logging.error(f"yt-dlp CLI error: {result.stderr}")
         return False
+    except DownloadInterrupted:
+        raise
     except Exception as e:
         logging.error(f"Error in yt-dlp CLI download: {e}")
         return False
 
 def download_with_yt_dlp_direct(video_url, output_path):
     """Try to download using yt-dlp with direct options"""
+    from yt_dlp import YoutubeDL
+
     try:
         # Create a temporary file for the output
         temp_output = os.path.join(os.path.dirname(output_path), f"temp_direct_{os.path.basename(output_path)}")
+        selector = FormatPolicySelector()
         
         # Simple options without cookies
         ydl_opts = {
-            'format': 'bestaudio/best',
+            **ytdlp_policy_options(selector),
             'outtmpl': temp_output,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
             'noplaylist': True,
             'quiet': True,
             'no_warnings': True,
@@ -534,39 +2047,43 @@ def download_with_yt_dlp_direct(video_url, output_path):
             'geo_bypass': True,
         }
         
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_url])
+        with YoutubeDL(with_deadline(ydl_opts)) as ydl:
+            with profile_stage('extract_info'):
+                selector.record(ydl.extract_info(video_url, download=True))
             
         # Find the downloaded file and rename it to the final output path
         temp_dir = os.path.dirname(temp_output)
         for file in os.listdir(temp_dir):
-            if file.startswith("temp_direct_") and file.endswith(".mp3"):
-                os.rename(os.path.join(temp_dir, file), output_path)
+            if file.startswith("temp_direct_") and file.endswith(f".{output_format}"):
+                with profile_stage('file_move'):
+                    os.rename(os.path.join(temp_dir, file), output_path)
                 return True
                 
         return False
+    except DownloadInterrupted:
+        raise
     except Exception as e:
         logging.error(f"Error in yt-dlp direct download: {e}")
         return False
 
-def download_with_yt_dlp_alternative(video_url, output_path):
+def download_with_yt_dlp_alternative(video_url, output_path, tags=None):
     """Try to download using yt-dlp with alternative options"""
+    from yt_dlp import YoutubeDL
+
     try:
         # Create a temporary directory
         temp_dir = tempfile.mkdtemp()
         temp_output = os.path.join(temp_dir, "output.%(ext)s")
+        selector = FormatPolicySelector()
+        cover_path = get_album_art(tags)
         
         # Alternative options that might bypass bot detection
         ydl_opts = {
-            'format': 'bestaudio',  # Changed to get best audio only
+            'format': selector,
             'outtmpl': temp_output,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-                'nopostoverwrites': False,
-            }],
-            'writethumbnail': True,
+            # The video thumbnail is only needed as cover art when Spotify has none
+            'writethumbnail': cover_path is None,
+            'postprocessors': [{'key': 'FFmpegThumbnailsConvertor', 'format': 'jpg'}] if cover_path is None else [],
             'noplaylist': True,
             'quiet': False,
             'no_warnings': False,
@@ -592,20 +2109,24 @@ def download_with_yt_dlp_alternative(video_url, output_path):
             'extractor_args': {'youtube': {'skip': ['dash', 'hls']}},
         }
         
-        with YoutubeDL(ydl_opts) as ydl:
+        with YoutubeDL(with_deadline(ydl_opts)) as ydl:
             try:
                 # Download the video
-                info = ydl.extract_info(video_url, download=True)
+                with profile_stage('extract_info'):
+                    info = ydl.extract_info(video_url, download=True)
                 if info is None:
                     logging.error("Failed to extract video info")
                     return False
-                
-                # Find the downloaded file
+                selector.record(info)
+
+                # Find the downloaded stream and thumbnail
                 downloaded_file = None
                 for file in os.listdir(temp_dir):
-                    if file.endswith('.mp3'):
+                    if file.endswith('.jpg'):
+                        if cover_path is None:
+                            cover_path = os.path.join(temp_dir, file)
+                    elif not file.endswith('.part'):
                         downloaded_file = os.path.join(temp_dir, file)
-                        break
                 
                 if downloaded_file is None:
                     logging.error("Could not find downloaded file")
@@ -618,21 +2139,24 @@ def download_with_yt_dlp_alternative(video_url, output_path):
                     shutil.rmtree(temp_dir)
                     return False
                 
-                # Move the file to the final location
+                # Remux or transcode, tag and embed cover art in a single write to the final location
                 try:
-                    shutil.copy2(downloaded_file, output_path)
+                    converted = convert_audio(downloaded_file, output_path, tags, cover_path)
                     shutil.rmtree(temp_dir)
-                    # Verify the final file
-                    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+                    if converted:
                         return True
                     else:
                         logging.error(f"Final file is invalid or empty: {output_path}")
                         return False
+                except DownloadInterrupted:
+                    raise
                 except Exception as e:
-                    logging.error(f"Error copying file to final location: {e}")
+                    logging.error(f"Error writing file to final location: {e}")
                     shutil.rmtree(temp_dir)
                     return False
                     
+            except DownloadInterrupted:
+                raise
             except Exception as e:
                 logging.error(f"Error during download: {e}")
                 shutil.rmtree(temp_dir)
@@ -640,6 +2164,9 @@ def download_with_yt_dlp_alternative(video_url, output_path):
                 
         shutil.rmtree(temp_dir)
         return False
+    except DownloadInterrupted:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
     except Exception as e:
         logging.error(f"Error in yt-dlp alternative download: {e}")
         try:
@@ -650,19 +2177,17 @@ def download_with_yt_dlp_alternative(video_url, output_path):
 
 def download_with_yt_dlp_legacy(video_url, output_path):
     """Try to download using yt-dlp with legacy options"""
+    from yt_dlp import YoutubeDL
+
     try:
         # Create a temporary file for the output
         temp_output = os.path.join(os.path.dirname(output_path), f"temp_legacy_{os.path.basename(output_path)}")
+        selector = FormatPolicySelector()
         
         # Legacy options that might work better
         ydl_opts = {
-            'format': 'bestaudio/best',
+            **ytdlp_policy_options(selector),
             'outtmpl': temp_output,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
             'noplaylist': True,
             'quiet': True,
             'no_warnings': True,
@@ -678,46 +2203,47 @@ def download_with_yt_dlp_legacy(video_url, output_path):
             'geo_bypass': True,
             'extractor_args': {'youtube': {'skip': ['dash', 'hls']}},
             'legacy_server_connect': True,
-            'merge_output_format': 'mp3',
         }
         
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_url])
+        with YoutubeDL(with_deadline(ydl_opts)) as ydl:
+            with profile_stage('extract_info'):
+                selector.record(ydl.extract_info(video_url, download=True))
             
-        # Find the downloaded file and convert it to MP3 if needed
+        # Find the downloaded file and convert it to the output format if needed
         temp_dir = os.path.dirname(temp_output)
         for file in os.listdir(temp_dir):
             if file.startswith("temp_legacy_"):
                 input_file = os.path.join(temp_dir, file)
-                if not file.endswith('.mp3'):
-                    if convert_to_mp3(input_file, output_path):
+                if not file.endswith(f".{output_format}"):
+                    if convert_audio(input_file, output_path):
                         os.remove(input_file)
                         return True
                     return False
                 else:
-                    os.rename(input_file, output_path)
+                    with profile_stage('file_move'):
+                        os.rename(input_file, output_path)
                     return True
                 
         return False
+    except DownloadInterrupted:
+        raise
     except Exception as e:
         logging.error(f"Error in yt-dlp legacy download: {e}")
         return False
 
 def download_with_yt_dlp_anonymous(video_url, output_path):
     """Try to download using yt-dlp with anonymous options"""
+    from yt_dlp import YoutubeDL
+
     try:
         # Create a temporary file for the output
         temp_output = os.path.join(os.path.dirname(output_path), f"temp_anon_{os.path.basename(output_path)}")
+        selector = FormatPolicySelector()
         
         # Anonymous options that might bypass bot detection
         ydl_opts = {
-            'format': 'bestaudio/best',
+            **ytdlp_policy_options(selector),
             'outtmpl': temp_output,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
             'noplaylist': True,
             'quiet': True,
             'no_warnings': True,
@@ -737,130 +2263,230 @@ def download_with_yt_dlp_anonymous(video_url, output_path):
             'legacy_server_connect': True,
             'no_cookies': True,
             'no_cache_dir': True,
-            'merge_output_format': 'mp3',
         }
         
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_url])
+        with YoutubeDL(with_deadline(ydl_opts)) as ydl:
+            with profile_stage('extract_info'):
+                selector.record(ydl.extract_info(video_url, download=True))
             
-        # Find the downloaded file and convert it to MP3 if needed
+        # Find the downloaded file and convert it to the output format if needed
         temp_dir = os.path.dirname(temp_output)
         for file in os.listdir(temp_dir):
             if file.startswith("temp_anon_"):
                 input_file = os.path.join(temp_dir, file)
-                if not file.endswith('.mp3'):
-                    if convert_to_mp3(input_file, output_path):
+                if not file.endswith(f".{output_format}"):
+                    if convert_audio(input_file, output_path):
                         os.remove(input_file)
                         return True
                     return False
                 else:
-                    os.rename(input_file, output_path)
+                    with profile_stage('file_move'):
+                        os.rename(input_file, output_path)
                     return True
                 
         return False
+    except DownloadInterrupted:
+        raise
     except Exception as e:
         logging.error(f"Error in yt-dlp anonymous download: {e}")
         return False
 
 # Download songs by searching YouTube and using yt-dlp
 def download_songs(selected_playlist):
-    global is_downloading
-    is_downloading = True
-
     user_path = path_label.cget("text")
-    
+
     # Error handling for invalid download path
     if user_path == "Select Download Path:":
-        messagebox.showerror("Error", "Please select a valid download path.")
+        show_error("Error", "Please select a valid download path.")
         return
 
-    download_folder = os.path.join(user_path, sanitize_filename(selected_playlist).replace(" ", "_"))
-    
+    try:
+        download_playlist(selected_playlist, playlists[selected_playlist], user_path)
+    except SpotifyAuthError:
+        set_status("Spotify authorization failed.")
+
+def download_playlist(playlist_name, playlist_id, user_path, tracks=None, youtube_ids=None):
+    """Download a playlist; tracks and youtube_ids from a snapshot skip the Spotify and YouTube lookups"""
+    global profiler
+    cancel_event.clear()
+    reset_format_stats()
+
+    download_folder = os.path.join(user_path, sanitize_filename(playlist_name).replace(" ", "_"))
+
     # Error handling for directory creation
     try:
         if not os.path.exists(download_folder):
             os.makedirs(download_folder)
     except OSError as e:
-        messagebox.showerror("Error", f"Failed to create download directory: {e}")
+        show_error("Error", f"Failed to create download directory: {e}")
         return
 
-    playlist_id = playlists[selected_playlist]
-    tracks = get_playlist_tracks(access_token, playlist_id)
+    if profile_mode:
+        profiler = StageProfiler(profile_mode)
+        profiler.start()
+    try:
+        sync_playlist_tracks(download_folder, playlist_name, playlist_id, tracks, youtube_ids)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write_report(download_folder)
+            profiler = None
+    set_status("Download completed.")
+    logging.info("Download completed for playlist.")
+
+def sync_playlist_tracks(download_folder, playlist_name, playlist_id, tracks=None, youtube_ids=None):
+    """Download the tracks missing from download_folder and record the plan in its snapshot"""
+    if tracks is None:
+        tracks = get_playlist_tracks(playlist_id)
+    snapshot_path = os.path.join(download_folder, SNAPSHOT_FILE)
+    if youtube_ids is None:
+        # Skipped tracks never get a new ID, so start from the folder's last plan to keep theirs
+        youtube_ids = load_snapshot_ids(snapshot_path)
+    youtube_ids = dict(youtube_ids)
     total_tracks = len(tracks)
 
+    # Verify files from earlier runs in parallel up front, only good ones are skipped
+    verify_cache = VerifyCache(download_folder)
+    existing = [(os.path.join(download_folder, f"{track_file_name(track)}.{output_format}"), track.duration_ms)
+                for track in tracks]
+    existing = [job for job in existing if os.path.exists(job[0])]
+    verified_files = {job[0] for job, (ok, _) in zip(existing, verify_files(existing, verify_cache)) if ok}
+    del existing
+
+    # Tracks that ran out of time get one more go after the rest of the playlist
+    requeued = []
+    requeued_keys = set()
+
     # Retry logic for track downloads
-    for track_num, track in enumerate(tracks, start=1):
-        if not is_downloading:
-            print("Downloading stopped by user.")
+    for track_num, track in itertools.chain(enumerate(tracks, start=1), requeued):
+        if cancel_event.is_set():
+            say("Downloading stopped by user.")
             break
 
         # Update progress in the GUI (call from main thread)
-        screen.after(0, update_status, track_num, total_tracks)
+        update_status(track_num, total_tracks)
 
-        sanitized_track_name = sanitize_filename(f"{track['track']['artists'][0]['name']} - {track['track']['name']}")
-        final_file = os.path.join(download_folder, f"{sanitized_track_name}.m4a")  # Add .m4a extension
+        sanitized_track_name = track_file_name(track)
+        tags = build_track_tags(track)
+        final_file = os.path.join(download_folder, f"{sanitized_track_name}.{output_format}")
 
-        # Check if the file already exists
-        if os.path.exists(final_file) and os.path.getsize(final_file) > 0:
-            print(f"Skipping, already downloaded: {final_file}")
+        # Skip files that already exist and passed verification
+        if final_file in verified_files:
+            say(f"Skipping, already downloaded: {final_file}", track_id=track.id, stage='skip')
             continue
 
+        track_start = time.perf_counter()
+        deadline = set_track_deadline(TRACK_TIME_BUDGET)
+        planned_id = youtube_ids.get(track_key(track))
         success = False
+        interrupted = None
         retries = 3  # Number of retries
         while retries > 0 and not success:
             try:
-                print(f"Processing {track['track']['name']} by {track['track']['artists'][0]['name']}... (Track {track_num}/{total_tracks})")
-                logging.info(f"Processing {track['track']['name']} by {track['track']['artists'][0]['name']}...")
+                deadline.check()
+                say(f"Processing {track.name} by {track.artist}... (Track {track_num}/{total_tracks})",
+                    track_id=track.id, stage='start')
 
-                search_query = f"{track['track']['name']} {track['track']['artists'][0]['name']} audio"
-                video_ids = search_youtube(search_query)
+                # Try the video chosen in the snapshot first, search again if it fails
+                if planned_id:
+                    video_ids = [planned_id]
+                    planned_id = None
+                else:
+                    search_query = f"{track.name} {track.artist} audio"
+                    with profile_stage('search_youtube'):
+                        video_ids = search_youtube(search_query)
 
                 if not video_ids:
-                    print("No videos found, retrying with different search...")
+                    say("No videos found, retrying with different search...", logging.WARNING,
+                        track_id=track.id, stage='search_youtube')
                     retries -= 1
-                    time.sleep(random.uniform(2, 4))  # Random delay between retries
+                    pause(2, 4)  # Random delay between retries
                     continue
 
                 for video_id in video_ids:
                     try:
+                        deadline.check()
                         video_url = f"https://www.youtube.com/watch?v={video_id}"
-                        
-                        print(f"Attempting to download: {video_url}")
-                        
+
+                        say(f"Attempting to download: {video_url}", track_id=track.id, stage='download')
+
                         # Try to download
-                        success = download_with_ytdlp(video_url, final_file, sanitized_track_name)
-                        
+                        if use_aria2():
+                            success = download_with_aria2(video_url, final_file, sanitized_track_name, tags,
+                                                          lambda percent, speed: update_progress(track_num, total_tracks, percent, speed))
+                        else:
+                            success = download_with_ytdlp(video_url, final_file, sanitized_track_name, tags)
+
+                        # Only count the track as done once the file passes verification
                         if success:
-                            print(f"Downloaded successfully: {final_file}")
-                            logging.info(f"Downloaded successfully: {final_file}")
-                            time.sleep(random.uniform(1, 2))  # Random delay between downloads
+                            with profile_stage('verify'):
+                                success, reason = get_verify_executor().submit(
+                                    verify_track_file, final_file, track.duration_ms, verify_cache).result()
+                            if success is None:
+                                # No verdict, the check was cut short or couldn't run: the file may be
+                                # fine, so leave it in place and stop here if the track was interrupted
+                                deadline.check()
+                                say(f"Couldn't verify {final_file}: {reason}", logging.WARNING,
+                                    track_id=track.id, stage='verify')
+                                success = True
+                            if not success:
+                                say(f"Verification failed for {video_id}: {reason}", logging.WARNING,
+                                    track_id=track.id, stage='verify')
+                                os.remove(final_file)
+                                continue
+
+                        if success:
+                            youtube_ids[track_key(track)] = video_id
+                            say(f"Downloaded successfully: {final_file}", track_id=track.id, stage='done',
+                                elapsed=round(time.perf_counter() - track_start, 2))
+                            pause(1, 2)  # Random delay between downloads
                             break
                         else:
-                            print(f"Download failed for video: {video_id}")
-                            logging.warning(f"Download failed for video: {video_id}")
-                            
+                            say(f"Download failed for video: {video_id}", logging.WARNING,
+                                track_id=track.id, stage='download')
+
+                    except DownloadInterrupted:
+                        raise
                     except Exception as e:
-                        print(f"Error downloading video: {e}")
-                        logging.error(f"Error downloading video for {track['track']['name']}: {e}")
+                        say(f"Error downloading video for {track.name}: {e}", logging.ERROR,
+                            track_id=track.id, stage='download')
                         continue
 
                 if not success:
                     retries -= 1
-                    print(f"Retrying... {retries} attempts left.")
-                    logging.warning(f"Retrying download for {track['track']['name']}... {retries} attempts left.")
-                    time.sleep(random.uniform(2, 4))  # Random delay before retrying
+                    say(f"Retrying download for {track.name}... {retries} attempts left.", logging.WARNING,
+                        track_id=track.id, stage='retry')
+                    pause(2, 4)  # Random delay before retrying
 
+            except DownloadInterrupted as e:
+                interrupted = str(e)
+                break
             except Exception as e:
-                print(f"Error processing track {track['track']['name']}: {e}")
-                logging.error(f"Error processing track {track['track']['name']}: {e}")
+                say(f"Error processing track {track.name}: {e}", logging.ERROR, track_id=track.id, stage='retry')
                 retries -= 1
-                time.sleep(random.uniform(2, 4))  # Random delay before retrying
+                pause(2, 4)  # Random delay before retrying
+
+        set_track_deadline(None)
+        if interrupted and cancel_event.is_set():
+            say("Downloading stopped by user.", track_id=track.id, stage='cancelled')
+            break
+        elif interrupted and track_key(track) not in requeued_keys:
+            # Park slow outliers at the end instead of letting one track stall the playlist
+            requeued_keys.add(track_key(track))
+            requeued.append((track_num, track))
+            say(f"Abandoning {track.name} for now ({interrupted}), retrying at the end", logging.WARNING,
+                track_id=track.id, stage='requeue', elapsed=round(time.perf_counter() - track_start, 2))
+        elif not success:
+            say(f"Giving up on {track.name}", logging.ERROR, track_id=track.id, stage='failed',
+                elapsed=round(time.perf_counter() - track_start, 2))
 
         # Clear references to the track to save memory
         del track
 
-    screen.after(0, status_label.config, {'text': "Download completed."})
-    logging.info("Download completed for playlist.")
+    verify_cache.save()
+    # Record the plan with the videos actually used so the run can be replayed offline
+    write_snapshot(snapshot_path, playlist_id, playlist_name, tracks, youtube_ids)
+    log_format_savings()
 
 # Function to start download in a new thread
 def start_download():
@@ -868,43 +2494,289 @@ def start_download():
 
 # Allow the user to select a download path
 def select_path():
-    global path_label
+    from tkinter import filedialog
+
     path = filedialog.askdirectory()
     if path:
         path_label.config(text=path)
 
-# GUI setup
-screen = Tk()
-screen.title('Spotify Downloader')
-screen.geometry("600x400")
+def build_gui():
+    """Create the main window; tkinter is only imported when the GUI is actually used"""
+    global screen, path_label, selected_playlist, playlist_dropdown, status_label
+    from tkinter import Tk, ttk, StringVar
+
+    # GUI setup
+    screen = Tk()
+    screen.title('Spotify Downloader')
+    screen.geometry("600x400")
+
+    # Styling
+    style = ttk.Style(screen)
+    style.theme_use('clam')
+
+    # Layout with improved spacing
+    frame = ttk.Frame(screen, padding="20")
+    frame.pack(fill='both', expand=True)
+
+    # Path selection
+    path_label = ttk.Label(frame, text="Select Download Path:")
+    path_label.pack(pady=10)
+    select_path_button = ttk.Button(frame, text="Browse", command=select_path)
+    select_path_button.pack(pady=10)
+
+    selected_playlist = StringVar()
+    playlist_dropdown = ttk.OptionMenu(frame, selected_playlist, "Loading playlists...")
+    playlist_dropdown.pack(pady=10)
+
+    download_button = ttk.Button(frame, text="Download", command=start_download)
+    download_button.pack(pady=10)
+
+    stop_button = ttk.Button(frame, text="Stop Downloading", command=stop_downloading)
+    stop_button.pack(pady=10)
+
+    status_label = ttk.Label(frame, text="")
+    status_label.pack(pady=10)
+
+def run_gui():
+    build_gui()
+    check_dependencies()
+    try:
+        get_user_playlists()
+    except SpotifyAuthError:
+        set_status("Spotify authorization failed, no playlists loaded.")
+    screen.mainloop()
+    return 0
+
+def run_headless(playlist, output):
+    """Download a playlist without the GUI"""
+    if not check_dependencies():
+        return 1
+    playlist_id = parse_playlist_id(playlist)
+    playlist_name = get_spotify_client().playlist(playlist_id, fields="name")["name"]
+    download_playlist(playlist_name, playlist_id, output)
+    return 0
 
-# Styling
-style = ttk.Style(screen)
-style.theme_use('clam')
+def run_from_snapshot(snapshot_path, output):
+    """Download the plan in a snapshot without contacting Spotify"""
+    if not check_dependencies():
+        return 1
+    header, tracks, youtube_ids = read_snapshot(snapshot_path)
+    download_playlist(header['name'], header['playlist_id'], output, tracks, youtube_ids)
+    return 0
 
-# Layout with improved spacing
-frame = ttk.Frame(screen, padding="20")
-frame.pack(fill='both', expand=True)
+def print_status():
+    """Quick status query, needs no network access and none of the heavy modules"""
+    print(f"Auth mode: {auth_mode}")
+    print(f"Audio: {quality_tier} quality, .{output_format}")
 
-# Path selection
-path_label = ttk.Label(frame, text="Select Download Path:")
-path_label.pack(pady=10)
-select_path_button = ttk.Button(frame, text="Browse", command=select_path)
-select_path_button.pack(pady=10)
+    # Each auth mode keeps its token in its own cache file, see create_auth_manager
+    cache_path = CLIENT_CREDENTIALS_CACHE if auth_mode == "client_credentials" else '.cache'
+    try:
+        with open(cache_path) as f:
+            token_info = json.load(f)
+        remaining = token_info.get('expires_at', 0) - time.time()
+        if remaining > 0:
+            print(f"Token cache: valid for {int(remaining // 60)} more minutes")
+        else:
+            print("Token cache: expired, will be refreshed on next use")
+    except (IOError, ValueError):
+        print("Token cache: none, authorization needed on next use")
+
+    for name in DEPENDENCY_PROBES:
+        print(f"{name}: {shutil.which(name) or 'not found'}")
+    return 0
+
+def median_ms(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2] if samples else float('inf')
+
+def benchmark_startup(runs=5):
+    """Measure cold start of the headless path against IMPORT_BUDGET_MS and STARTUP_BUDGET_MS"""
+    script_path = os.path.abspath(__file__)
+    script_dir = os.path.dirname(script_path)
+
+    # Cumulative import time of this module as reported by -X importtime
+    import_samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                                cwd=script_dir, capture_output=True, text=True)
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[2].strip() == 'main':
+                import_samples.append(int(parts[1]) / 1000)
+
+    # Wall time of a full interpreter start running the status query
+    startup_samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, script_path, '--status'], cwd=script_dir, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"Status query failed: {result.stderr.strip().splitlines()[-1:]}")
+            return 1
+        startup_samples.append((time.perf_counter() - start) * 1000)
 
-selected_playlist = StringVar()
-playlist_dropdown = ttk.OptionMenu(frame, selected_playlist, "Loading playlists...")
-playlist_dropdown.pack(pady=10)
+    import_ms = median_ms(import_samples)
+    startup_ms = median_ms(startup_samples)
+    print(f"import main: {import_ms:.1f} ms (budget {IMPORT_BUDGET_MS} ms)")
+    print(f"main.py --status: {startup_ms:.1f} ms (budget {STARTUP_BUDGET_MS} ms)")
 
-get_user_playlists(access_token)
+    within_budget = import_ms <= IMPORT_BUDGET_MS and startup_ms <= STARTUP_BUDGET_MS
+    print("Startup within budget." if within_budget else "Startup over budget!")
+    return 0 if within_budget else 1
 
-download_button = ttk.Button(frame, text="Download", command=start_download)
-download_button.pack(pady=10)
+# Track counts for --benchmark-memory and the per-track memory budget they must stay under
+MEMORY_BENCHMARK_COUNTS = (10000, 25000, 50000)
+TRACK_MEMORY_BUDGET_BYTES = 1024
 
-stop_button = ttk.Button(frame, text="Stop Downloading", command=stop_downloading)
-stop_button.pack(pady=10)
+def synthetic_playlist_page(offset, limit, album_count=2000):
+    """Spotify-shaped playlist items for the memory benchmark, including the fields we drop"""
+    markets = ["AD", "AE", "AR", "AT", "AU", "BE", "BG", "BR", "CA", "CH", "CL", "CO", "CZ", "DE", "DK", "ES"] * 12
+    items = []
+    for index in range(offset, offset + limit):
+        album_index = index % album_count
+        artist = {'name': f"Artist {album_index % 700}", 'id': f"artist{album_index % 700:018d}", 'type': 'artist',
+                  'external_urls': {'spotify': f"https://open.spotify.com/artist/{album_index % 700}"}}
+        album = {
+            'id': f"album{album_index:017d}",
+            'name': f"Album {album_index}",
+            'release_date': f"20{album_index % 25:02d}-01-01",
+            'total_tracks': 12,
+            'artists': [artist],
+            'available_markets': list(markets),
+            'images': [{'url': f"https://i.scdn.co/image/{album_index}-{size}", 'height': size, 'width': size}
+                       for size in (640, 300, 64)],
+        }
+        items.append({'added_at': "2024-01-01T00:00:00Z", 'track': {
+            'id': f"track{index:017d}",
+            'name': f"Track {index}",
+            'duration_ms': 180000 + index % 60000,
+            'track_number': index % 12 + 1,
+            'disc_number': 1,
+            'external_ids': {'isrc': f"US{index:010d}"},
+            'artists': [artist],
+            'album': album,
+            'available_markets': list(markets),
+            'preview_url': f"https://p.scdn.co/mp3-preview/{index}",
+        }})
+    return {'items': items}
+
+def build_synthetic_tracks(count):
+    """Track list for count synthetic tracks, fetched page by page like get_playlist_tracks"""
+    tracks = []
+    for offset in range(0, count, 100):
+        tracks.extend(records_from_items(synthetic_playlist_page(offset, min(100, count - offset))['items']))
+    return tracks
+
+def peak_rss_bytes():
+    """Peak resident set size of this process"""
+    # VmHWM belongs to the address space, ru_maxrss on Linux carries over the parent's peak across exec
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # ru_maxrss is reported in KB on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
 
-status_label = ttk.Label(frame, text="")
-status_label.pack(pady=10)
+def track_list_rss(count):
+    """Peak RSS growth in bytes from building a count-track list in a fresh interpreter, None if unavailable"""
+    # The peak only ever grows, so each count needs its own process to be measured separately
+    code = ("import main; base = main.peak_rss_bytes(); "
+            f"tracks = main.build_synthetic_tracks({count}); print(main.peak_rss_bytes() - base)")
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-c', code], cwd=script_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return int(result.stdout.strip())
+
+def benchmark_memory(counts=MEMORY_BENCHMARK_COUNTS):
+    """Measure memory held by the track list of a large library sync and the peak RSS it adds"""
+    import tracemalloc
+
+    within_budget = True
+    for count in counts:
+        tracemalloc.start()
+        tracks = build_synthetic_tracks(count)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del tracks
+
+        per_track = current / count
+        within_budget = within_budget and per_track <= TRACK_MEMORY_BUDGET_BYTES
+        line = (f"{count} tracks: {current / (1024 * 1024):.1f} MB held ({per_track:.0f} bytes/track), "
+                f"peak {peak / (1024 * 1024):.1f} MB")
+
+        rss = track_list_rss(count)
+        if rss is not None:
+            within_budget = within_budget and rss / count <= TRACK_MEMORY_BUDGET_BYTES
+            line += f", peak RSS +{rss / (1024 * 1024):.1f} MB ({rss / count:.0f} bytes/track)"
+        print(line)
+
+    print(f"Track memory within {TRACK_MEMORY_BUDGET_BYTES} bytes/track." if within_budget else "Track memory over budget!")
+    return 0 if within_budget else 1
+
+def main(argv=None):
+    global quiet, download_backend, profile_mode
+    parser = argparse.ArgumentParser(description="Download Spotify playlists via YouTube")
+    parser.add_argument('--playlist', help="playlist ID, URI or URL to download without the GUI")
+    parser.add_argument('--output', default='.', help="download directory for --playlist")
+    parser.add_argument('--export-snapshot', metavar='PATH', help="save the --playlist plan to a snapshot file and exit")
+    parser.add_argument('--resolve', action='store_true', help="with --export-snapshot, also pick YouTube videos")
+    parser.add_argument('--from-snapshot', metavar='PATH', help="download a snapshot's plan without Spotify access")
+    parser.add_argument('--merge-snapshots', nargs='+', metavar='PATH', help="merge snapshots into --snapshot-out")
+    parser.add_argument('--snapshot-out', default=SNAPSHOT_FILE, help="output file for --merge-snapshots")
+    parser.add_argument('--diff-snapshots', nargs=2, metavar=('OLD', 'NEW'), help="show changes between two snapshots")
+    parser.add_argument('--aria2', action='store_true', help="download through an aria2c RPC daemon")
+    parser.add_argument('--verify-library', metavar='DIR', help="re-check every audio file under DIR and exit")
+    parser.add_argument('--quiet', action='store_true', help="drop per-track console output, the log keeps everything")
+    parser.add_argument('--log-file', default=LOG_FILE, help="JSON log file, rotated by size")
+    parser.add_argument('--profile', nargs='?', const='sample', choices=['sample', 'cprofile'],
+                        help="profile the run and write a stage report and stack file to the download folder")
+    parser.add_argument('--status', action='store_true', help="show configuration and token status and exit")
+    parser.add_argument('--benchmark-startup', action='store_true', help="measure cold-start time against the budget")
+    parser.add_argument('--benchmark-memory', action='store_true', help="measure track list memory for large libraries")
+    args = parser.parse_args(argv)
+
+    if args.benchmark_startup:
+        return benchmark_startup()
+    if args.benchmark_memory:
+        return benchmark_memory()
+
+    quiet = args.quiet
+    setup_logging(args.log_file)
+    load_config()
+
+    if args.aria2:
+        download_backend = 'aria2'
+    if args.profile:
+        profile_mode = args.profile
+
+    if args.status:
+        return print_status()
+    if args.verify_library:
+        return verify_library(args.verify_library)
+    if args.merge_snapshots:
+        return merge_snapshots(args.merge_snapshots, args.snapshot_out)
+    if args.diff_snapshots:
+        return diff_snapshots(*args.diff_snapshots)
+    if args.from_snapshot:
+        return run_from_snapshot(args.from_snapshot, args.output)
+    if args.export_snapshot:
+        if not args.playlist:
+            parser.error("--export-snapshot needs --playlist")
+        try:
+            return export_snapshot(args.playlist, args.export_snapshot, args.resolve)
+        except SpotifyAuthError:
+            return 1
+    if args.playlist:
+        try:
+            return run_headless(args.playlist, args.output)
+        except SpotifyAuthError:
+            return 1
+    return run_gui()
 
-screen.mainloop()
+if __name__ == "__main__":
+    sys.exit(main())